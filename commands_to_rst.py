@@ -1,9 +1,16 @@
 #!/usr/bin/env python
+import argparse
+import hashlib
+import json
+import multiprocessing
 import os
 import sys
+from concurrent.futures import ProcessPoolExecutor
 from string import Template
+import click
 import yaml
 from importlib import import_module
+from importlib.metadata import version
 from click.testing import CliRunner
 
 project_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
@@ -39,83 +46,179 @@ Commands
 """ % CONF_DATA['documentation']
 
 command_doc_dir = os.path.join("docs", "commands")
-commands = COMMANDS_TEMPLATE
-
-for command in cli_module.list_cmds():
-    if command == 'init':
-        # Skip documenting init because it's special
-        continue
-
-    commands += "\n   commands/%s.rst" % command
-    parent_doc_handle = open(os.path.join(command_doc_dir, command + ".rst"), "w")
-    parent_doc_handle.write('%s\n' % command)
-    parent_doc_handle.write('%s\n' % ('=' * len(command)))
-    parent_doc_handle.write(Template("""
+# Digests of the inputs each group page was last rendered from, so unchanged
+# groups can be skipped (and keep their mtime, which sphinx rebuilds on).
+digest_path = os.path.join(command_doc_dir, ".digests.json")
+
+
+def clean_rst_line(line, remove=4):
+    if line.startswith(" " * remove):
+        return line[remove:]
+    else:
+        return line
+
+
+def group_digest(command, generator_source):
+    """Hash the formatted help text the page for ``command`` is rendered from."""
+    # Contexts go through make_context, as with ``--help``, so each command's
+    # context_settings apply. Nothing is invoked here, so docs_reset_hook is
+    # left to the render path.
+    root_ctx = base_cli.make_context(CONF_DATA['project_name'], [], resilient_parsing=True)
+    group_obj = base_cli.get_command(root_ctx, command)
+    group_ctx = group_obj.make_context(command, [], parent=root_ctx, resilient_parsing=True)
+    digest = hashlib.sha256()
+    for part in (generator_source, version('click'), CONF_DATA['project_name']):
+        digest.update(part.encode('utf-8') + b'\0')
+
+    for subcommand in cli_module.list_subcmds(command):
+        command_obj = cli_module.name_to_command(command, subcommand)
+        ctx = command_obj.make_context(subcommand, [], parent=group_ctx, resilient_parsing=True)
+        for part in (subcommand, command_obj.callback.__doc__ or '', command_obj.get_help(ctx)):
+            digest.update(part.encode('utf-8') + b'\0')
+    return digest.hexdigest()
+
+
+def render_subcommand(command, subcommand):
+    if 'docs_reset_hook' in CONF_DATA:
+        eval(CONF_DATA['docs_reset_hook'])
+
+    command_obj = cli_module.name_to_command(command, subcommand)
+
+    function = command_obj.callback
+    raw_rst = function.__doc__
+
+    clean_rst = "\n".join(map(clean_rst_line, raw_rst.split("\n")))
+    if 'Output:' in clean_rst:
+        output_rst = clean_rst[clean_rst.index('Output:') + len('Output:'):].lstrip('\n')
+        clean_rst = clean_rst[0:clean_rst.index('Output:')]
+        output_rst = "\n".join([clean_rst_line(x, remove=5) for x in raw_rst.split("\n")])
+    else:
+        output_rst = ""
+
+    result = runner.invoke(base_cli, [command, subcommand, "--help"])
+    print(result)
+    output = result.output
+    lines = output.split("\n")
+    new_lines = []
+    help_lines = False
+    option_lines = False
+    output_lines = False
+
+    for line in lines:
+        if line.startswith("Usage: "):
+            new_lines.append("**Usage**::\n\n    %s" % line[len("Usage: "):])
+            new_lines.append("\n**Help**\n")
+            new_lines.append(clean_rst)
+            help_lines = True
+            option_lines = False
+            output_lines = False
+        elif line.startswith("Options:"):
+            help_lines = False
+            option_lines = True
+            output_lines = False
+            new_lines.append("**Options**::\n\n")
+        elif line.strip().startswith("Output:"):
+            help_lines = False
+            option_lines = False
+            output_lines = True
+            new_lines.append("**Output**\n\n")
+            new_lines.append(output_rst[output_rst.index('Output:') + len('Output:'):].lstrip('\n'))
+        elif option_lines:
+            new_lines.append("    %s" % line)
+        elif output_lines:
+            pass
+    return COMMAND_TEMPLATE.safe_substitute(
+        command=command,
+        subcommand=subcommand,
+        command_help="\n".join(new_lines),
+        module_underline="-" * (len(subcommand) + len('```` command'))
+    )
+
+
+def render_group(command):
+    text = '%s\n' % command
+    text += '%s\n' % ('=' * len(command))
+    text += Template("""
 This section is auto-generated from the help text for the ${library} command
 ``${command}``.
 
-""").safe_substitute(command=command, library=CONF_DATA['project_name']))
+""").safe_substitute(command=command, library=CONF_DATA['project_name'])
 
     for subcommand in cli_module.list_subcmds(command):
-        if 'docs_reset_hook' in CONF_DATA:
-            eval(CONF_DATA['docs_reset_hook'])
-
-        command_obj = cli_module.name_to_command(command, subcommand)
-
-        function = command_obj.callback
-        raw_rst = function.__doc__
-
-        def clean_rst_line(line, remove=4):
-            if line.startswith(" " * remove):
-                return line[remove:]
-            else:
-                return line
-        clean_rst = "\n".join(map(clean_rst_line, raw_rst.split("\n")))
-        if 'Output:' in clean_rst:
-            output_rst = clean_rst[clean_rst.index('Output:') + len('Output:'):].lstrip('\n')
-            clean_rst = clean_rst[0:clean_rst.index('Output:')]
-            output_rst = "\n".join([clean_rst_line(x, remove=5) for x in raw_rst.split("\n")])
-        else:
-            output_rst = ""
-
-        result = runner.invoke(base_cli, [command, subcommand, "--help"])
-        print(result)
-        output = result.output
-        lines = output.split("\n")
-        new_lines = []
-        help_lines = False
-        option_lines = False
-        output_lines = False
-
-        for line in lines:
-            if line.startswith("Usage: "):
-                new_lines.append("**Usage**::\n\n    %s" % line[len("Usage: "):])
-                new_lines.append("\n**Help**\n")
-                new_lines.append(clean_rst)
-                help_lines = True
-                option_lines = False
-                output_lines = False
-            elif line.startswith("Options:"):
-                help_lines = False
-                option_lines = True
-                output_lines = False
-                new_lines.append("**Options**::\n\n")
-            elif line.strip().startswith("Output:"):
-                help_lines = False
-                option_lines = False
-                output_lines = True
-                new_lines.append("**Output**\n\n")
-                new_lines.append(output_rst[output_rst.index('Output:') + len('Output:'):].lstrip('\n'))
-            elif option_lines:
-                new_lines.append("    %s" % line)
-            elif output_lines:
-                pass
-        text = COMMAND_TEMPLATE.safe_substitute(
-            command=command,
-            subcommand=subcommand,
-            command_help="\n".join(new_lines),
-            module_underline="-" * (len(subcommand) + len('```` command'))
-        )
-        parent_doc_handle.write(text)
-
-open(os.path.join("docs", "commands.rst"), "w").write(commands)
+        text += render_subcommand(command, subcommand)
+    return command, text
+
+
+def write_if_changed(path, text):
+    """Write ``text`` to ``path`` unless it already holds exactly that."""
+    if os.path.exists(path):
+        with open(path, 'r') as handle:
+            if handle.read() == text:
+                return False
+    with open(path, 'w') as handle:
+        handle.write(text)
+    return True
+
+
+def load_digests():
+    try:
+        with open(digest_path, 'r') as handle:
+            return json.load(handle)
+    except (IOError, ValueError):
+        return {}
+
+
+def main(jobs=None, force=False):
+    with open(os.path.abspath(__file__), 'r') as handle:
+        generator_source = handle.read()
+
+    old_digests = {} if force else load_digests()
+    new_digests = {}
+    stale = []
+    commands = COMMANDS_TEMPLATE
+
+    for command in cli_module.list_cmds():
+        if command == 'init':
+            # Skip documenting init because it's special
+            continue
+
+        commands += "\n   commands/%s.rst" % command
+        new_digests[command] = group_digest(command, generator_source)
+        page = os.path.join(command_doc_dir, command + ".rst")
+        if old_digests.get(command) != new_digests[command] or not os.path.exists(page):
+            stale.append(command)
+
+    # Workers rely on inheriting the loaded config, imported modules and CLI
+    # from this process; under spawn they would re-run the module top level, so
+    # render serially where fork is unavailable (e.g. Windows).
+    if jobs == 1 or len(stale) < 2 or 'fork' not in multiprocessing.get_all_start_methods():
+        rendered = map(render_group, stale)
+        pool = None
+    else:
+        pool = ProcessPoolExecutor(max_workers=jobs, mp_context=multiprocessing.get_context('fork'))
+        rendered = pool.map(render_group, stale)
+
+    try:
+        for command, text in rendered:
+            write_if_changed(os.path.join(command_doc_dir, command + ".rst"), text)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    write_if_changed(os.path.join("docs", "commands.rst"), commands)
+    write_if_changed(digest_path, json.dumps(new_digests, indent=2, sort_keys=True) + '\n')
+
+
+def positive_int(value):
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError("must be at least 1, got %s" % value)
+    return number
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='render CLI help text into sphinx documentation')
+    parser.add_argument('--jobs', type=positive_int, default=None, help="Number of worker processes (default: one per CPU)")
+    parser.add_argument('--force', action='store_true', help="Re-render every command group, ignoring stored digests")
+    args = parser.parse_args()
+    main(jobs=args.jobs, force=args.force)